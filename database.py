@@ -1,14 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from config import Config
 
+# SQLite connections are handed between Streamlit script threads by the pool
+connect_args = {"check_same_thread": False} if Config.SQLALCHEMY_DATABASE_URI.startswith("sqlite") else {}
+
 # Create engine
-engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)#, echo=True,pool_pre_ping=True
+engine = create_engine(Config.SQLALCHEMY_DATABASE_URI,
+                       pool_size=5,
+                       max_overflow=10,
+                       pool_pre_ping=True,
+                       pool_recycle=1800,
+                       connect_args=connect_args)
 
 # Create session maker
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Session = SessionLocal()
+# One session per thread, returned to the pool with ScopedSession.remove()
+ScopedSession = scoped_session(SessionLocal)
+
+# Background writer for append-only rows the UI does not need to wait for
+writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="db-writer")
+
+def _run_write(fn, args):
+    try:
+        fn(*args)
+    except Exception as e:
+        print(f"Background DB write failed: {e!r}")
+    finally:
+        # Each task gets its own thread-local session; return it to the pool
+        ScopedSession.remove()
+
+def write_async(fn, *args):
+    return writer.submit(_run_write, fn, args)
 
 # Base class for models
 Base = declarative_base()
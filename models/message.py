@@ -3,7 +3,7 @@ from sqlalchemy.orm import relationship
 
 import database
 from database import Base, SessionLocal
-from models.user import get_user_by_email
+from models.user import get_user_id_by_email
 
 
 # Initialize SQLAlchemy base
@@ -38,12 +38,19 @@ class Message(Base):
 
 # Example: Save a new message
 def save_message(role, content, to, from_, timestamp, email, session_id):
-    the_user = get_user_by_email(email)
-    new_message = Message(role=role, content=content, to=to, from_=from_, timestamp=timestamp, user=the_user, session_id=session_id)
-    database.Session.add(new_message)
-    database.Session.commit()
+    user_id = get_user_id_by_email(email)
+    new_message = Message(role=role, content=content, to=to, from_=from_, timestamp=timestamp, user_id=user_id, session_id=session_id)
+    database.ScopedSession.add(new_message)
+    database.ScopedSession.commit()
+
+
+# Save several messages of one user with a single commit
+def save_messages(rows, email):
+    user_id = get_user_id_by_email(email)
+    database.ScopedSession.bulk_insert_mappings(Message, [dict(row, user_id=user_id) for row in rows])
+    database.ScopedSession.commit()
 
 
 # Example: Query all messages
 def get_all_messages():
-    return database.Session.query(Message).all()
+    return database.ScopedSession.query(Message).all()
@@ -3,7 +3,7 @@ from sqlalchemy.orm import relationship
 
 import database
 from database import Base, SessionLocal
-from models.user import get_user_by_email
+from models.user import get_user_id_by_email
 
 
 # Initialize SQLAlchemy base
@@ -31,8 +31,8 @@ class Result(Base):
 
 # Example: Save a new message
 def save_result(summarize, timestamp, email, session_id):
-    the_user = get_user_by_email(email)
-    new_message = Result(summarize=summarize, timestamp=timestamp, user=the_user, session_id=session_id)
-    database.Session.add(new_message)
-    database.Session.commit()
+    user_id = get_user_id_by_email(email)
+    new_message = Result(summarize=summarize, timestamp=timestamp, user_id=user_id, session_id=session_id)
+    database.ScopedSession.add(new_message)
+    database.ScopedSession.commit()
 
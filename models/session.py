@@ -5,7 +5,7 @@ from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.orm import relationship
 
 import database
-from database import Base, Session
+from database import Base
 
 class Session(Base):
     __tablename__ = "sessions"
@@ -21,6 +21,6 @@ class Session(Base):
 
 def create_new_session(name: str):
     new_session = Session(name=name, created_at=datetime.now())
-    database.Session.add(new_session)
-    database.Session.commit()
+    database.ScopedSession.add(new_session)
+    database.ScopedSession.commit()
     return new_session.id
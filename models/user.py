@@ -1,26 +1,32 @@
 from requests import Session
 from sqlalchemy import Column, Integer, String
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import relationship
-from database import Base, Session
+from database import Base, ScopedSession, engine
 
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
-    email = Column(String, unique=True, nullable=False)
+    email = Column(String, unique=True, nullable=False, index=True)
 
     # Define relationship to Message model
     messages = relationship("Message", back_populates="user", cascade="all, delete-orphan")
     results = relationship("Result", back_populates="user", cascade="all, delete-orphan")
 
 
-def add_user(new_user, user_email):
-    if get_user_by_email(user_email):
-        return
-    Session.add(new_user)
-    Session.commit()
+def add_user(name, email):
+    # Single idempotent statement; an existing email is left untouched
+    insert = sqlite.insert if engine.dialect.name == "sqlite" else postgresql.insert
+    stmt = insert(User).values(name=name, email=email).on_conflict_do_nothing(index_elements=["email"])
+    ScopedSession.execute(stmt)
+    ScopedSession.commit()
 
 def get_user_by_email(email):
-    user = Session.query(User).filter(User.email == email).first()
+    user = ScopedSession.query(User).filter(User.email == email).first()
     return user
+
+# Only the id, without hydrating a User object
+def get_user_id_by_email(email):
+    return ScopedSession.query(User.id).filter(User.email == email).scalar()
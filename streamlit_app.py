@@ -1,78 +1,64 @@
 import json
+import os
 from datetime import datetime
 from xml.dom.minidom import Document
 
+import httpx
 import openai
 import streamlit as st
+import tiktoken
 
 import database
-from models.message import save_message
+from models.message import save_messages
 from models.result import save_result
 from models.session import create_new_session
 import models
 from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
+from langchain.globals import set_llm_cache, get_llm_cache as get_global_llm_cache
+from langchain_core.caches import InMemoryCache
+from langchain_core.outputs import Generation
+from langchain.memory import ConversationSummaryBufferMemory
 from sentence_transformers import SentenceTransformer, util
-from langchain.prompts.chat import ChatPromptTemplate
 from langchain.schema import HumanMessage, AIMessage, SystemMessage, messages_to_dict
-from langchain.chains.summarize import load_summarize_chain
-from langchain.docstore.document import Document
 
 
 
-# Add custom CSS for right-to-left text styling
-st.markdown(
-    """
+# Static markup, built once here. Streamlit drops any element a rerun does
+# not emit, so these still have to be written on every run.
+RTL_CSS = """
     <style>
     body {
         direction: rtl;
         text-align: right;
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
-
-def get_chat_history():
-    all_messages = st.session_state.memory.chat_memory.messages
-    student_messages = [msg for msg in all_messages if isinstance(msg, HumanMessage)]
-    return messages_to_dict(student_messages[st.session_state.starting_index:])
-
-
-def import_llm_models():
-    OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
-    llm = ChatOpenAI(api_key=OPENAI_API_KEY,
-                     model="gpt-4o",
-                     temperature=0.3)
-    return llm
-
-def load_character_prompt_txt(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read().strip()
-
-def load_character_prompt_json(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-def load_initial_conversation(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """
 
-if 'database_initialized' not in st.session_state:
-    database.create_database()
-    st.session_state.database_initialized = True
+MEDICAL_RECORD_HTML = """
+        <div style="background-color: #f0f8ff; padding: 10px; border-radius: 10px;direction: rtl; text-align: right;">
+            <strong>תיק רפואי של מר. יונתן בניון:</strong> <br>
+            <strong>COPD מתקדם:</strong> Prednisolone 10 mg, Fluticasone inhaler 500 mcg, חמצן <br>
+            <strong>יתר לחץ דם:</strong> Amlodipine 5 mg, Furosemide 40 mg <br>
+            <strong>סוכרת סוג 2:</strong> Novorapid <br>
+            <strong>היסטוריה של עישון כבד:</strong> 40 שנות קופסא, הפסיק לעשן לפני 5 שנים
+        </div>
+        """
 
-if 'session_id' not in st.session_state:
-    st.session_state['session_id'] = create_new_session("Chat Session Name")
+# Add custom CSS for right-to-left text styling
+st.markdown(RTL_CSS, unsafe_allow_html=True)
 
-if 'chat_initialized' not in st.session_state:
-    # connect openai key
-    openai.api_key = st.secrets["OPENAI_API_KEY"]
-    st.session_state.llm = import_llm_models()
-    st.session_state.memory = ConversationBufferMemory(memory_key="chat_history")
+@st.cache_resource
+def get_llm_cache():
+    # Shared by every session of this server process
+    return InMemoryCache(maxsize=256)
 
+# Exact-repeat LLM calls skip the OpenAI round trip; the persona chat opts out
+if os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true":
+    set_llm_cache(get_llm_cache())
 
-    st.session_state.system_template = """
+# Static persona prompt. It is always sent first and never interpolated, so
+# OpenAI's automatic prefix caching can reuse it across turns and users.
+SYSTEM_TEMPLATE = """
     אתה משחק את תפקיד המטופל, יונתן בניון, בן 68, בתרחיש רפואי טלפוני לאימון אחיות. 
     המטרה שלך היא לשקף בצורה אותנטית את מצבו של המטופל, כולל תסמינים פיזיים ורגשיים, ולתרום לאימון אפקטיבי של האחיות.
     וחכה לשאלות מהמשתמש.
@@ -159,14 +145,134 @@ if 'chat_initialized' not in st.session_state:
     - אל תתן מיד תוצאות של סטורציה.
     - אל תתן מיד תוצאות של סוכר בדם. 
         </div>
-
-        היסטוריית השיחה:
-        {chat_history}
         """
 
-    st.session_state.system_prompt = ChatPromptTemplate.from_messages(
-        [("system", st.session_state.system_template)]
-    )
+
+# OpenAI calls fail fast instead of stalling the page; the client retries with
+# jittered exponential backoff, then the UI shows SERVICE_BUSY_MESSAGE
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+SERVICE_BUSY_MESSAGE = "השירות עמוס כרגע, נסו שוב בעוד מספר רגעים."
+# Once a stream has started the SDK reads the body directly, so transport
+# failures (e.g. httpx.ReadTimeout) surface unwrapped rather than as APIError
+LLM_ERRORS = (openai.APIError, httpx.TransportError)
+
+# Token budget for the recent turns sent after the persona prompt and summary
+CHAT_TOKEN_BUDGET = 1500
+
+
+def get_chat_history():
+    all_messages = st.session_state.transcript
+    student_messages = [msg for msg in all_messages if isinstance(msg, HumanMessage)]
+    return messages_to_dict(student_messages[st.session_state.starting_index:])
+
+
+@st.cache_resource
+def get_openai_api_key():
+    # Read from secrets once per server process
+    return st.secrets["OPENAI_API_KEY"]
+
+def import_llm_models():
+    OPENAI_API_KEY = get_openai_api_key()
+    llm = ChatOpenAI(api_key=OPENAI_API_KEY,
+                     model="gpt-4o-2024-08-06",
+                     temperature=0.3,
+                     streaming=True,
+                     stream_usage=True,
+                     cache=False,
+                     timeout=LLM_TIMEOUT,
+                     max_retries=LLM_MAX_RETRIES)
+    return llm
+
+def import_summary_llm():
+    OPENAI_API_KEY = get_openai_api_key()
+    summary_llm = ChatOpenAI(api_key=OPENAI_API_KEY,
+                             model="gpt-4o-mini",
+                             temperature=0,
+                             timeout=LLM_TIMEOUT,
+                             max_retries=LLM_MAX_RETRIES)
+    return summary_llm
+
+def import_eval_llm():
+    OPENAI_API_KEY = get_openai_api_key()
+    # Feedback is four short sections, so a bounded budget keeps it quick
+    eval_llm = ChatOpenAI(api_key=OPENAI_API_KEY,
+                          model="gpt-4o-mini",
+                          temperature=0.2,
+                          max_tokens=400,
+                          timeout=LLM_TIMEOUT,
+                          max_retries=LLM_MAX_RETRIES)
+    return eval_llm
+
+@st.cache_resource
+def get_token_encoder():
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def pack_tail(messages, budget=CHAT_TOKEN_BUDGET):
+    # Newest messages that fit in the budget, counted locally; the newest is always kept
+    encoder = get_token_encoder()
+    packed = []
+    used = 0
+    for msg in reversed(messages):
+        tokens = len(encoder.encode(msg.content))
+        if packed and used + tokens > budget:
+            break
+        packed.append(msg)
+        used += tokens
+    return packed[::-1]
+
+def stream_llm_response(messages):
+    # The "AI:" prefix is stripped as the text streams, so the live bubble
+    # matches the transcript copy drawn on later reruns
+    pending = ""
+    for chunk in st.session_state.llm.stream(messages):
+        if chunk.usage_metadata:
+            cached_tokens = chunk.usage_metadata.get("input_token_details", {}).get("cache_read", 0)
+            print(f"Prompt tokens: {chunk.usage_metadata['input_tokens']}, cached: {cached_tokens}")
+        text = (pending + chunk.content).replace("AI:", "")
+        # Hold back a trailing "A" or "AI" in case the marker spans two chunks
+        held = 2 if text.endswith("AI") else 1 if text.endswith("A") else 0
+        pending = text[len(text) - held:]
+        yield text[:len(text) - held]
+    yield pending
+
+def load_character_prompt_txt(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def load_character_prompt_json(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_initial_conversation(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@st.cache_resource
+def init_database():
+    # Runs once per server process rather than once per browser session
+    database.create_database()
+
+init_database()
+
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = create_new_session("Chat Session Name")
+
+if 'chat_initialized' not in st.session_state:
+    # connect openai key
+    openai.api_key = get_openai_api_key()
+    st.session_state.llm = import_llm_models()
+    st.session_state.eval_llm = import_eval_llm()
+    # Older turns are folded into a rolling summary so the prompt stays bounded
+    st.session_state.memory = ConversationSummaryBufferMemory(llm=import_summary_llm(),
+                                                              max_token_limit=800,
+                                                              memory_key="chat_history",
+                                                              return_messages=True)
+    # Full conversation, kept for display and feedback since the memory prunes itself
+    st.session_state.transcript = []
+
+    # The prompt never changes, so its message is built once and reused every turn
+    st.session_state.system_message = SystemMessage(content=SYSTEM_TEMPLATE)
 
 
     initial_conversation = [
@@ -180,8 +286,8 @@ if 'chat_initialized' not in st.session_state:
     st.session_state.starting_index = len(initial_conversation) * 2
 
     for human_msg, ai_msg in initial_conversation:
-        st.session_state.memory.chat_memory.add_message(human_msg)
-        st.session_state.memory.chat_memory.add_message(ai_msg)
+        st.session_state.memory.save_context({"input": human_msg.content}, {"output": ai_msg.content})
+        st.session_state.transcript.extend([human_msg, ai_msg])
 
 
     st.session_state.chat_initialized = True
@@ -189,86 +295,74 @@ if 'chat_initialized' not in st.session_state:
 if 'page' not in st.session_state:
     st.session_state.page = "Home"  # Default page is Home
 
+def record_turn(human_message, ai_response):
+    st.session_state.transcript.extend([human_message, AIMessage(content=ai_response)])
+
+    current_time = datetime.now()
+    user_row = dict(role="user", content=human_message.content, to=st.session_state.user_name,
+                    from_="assistant", timestamp=current_time,
+                    session_id=st.session_state['session_id'])
+    response_time = datetime.now()
+    assistant_row = dict(role="user", content=ai_response, to="assistant",
+                         from_=st.session_state.user_name, timestamp=response_time,
+                         session_id=st.session_state['session_id'])
+    # Both rows of the turn go out in one transaction, off the render path
+    database.write_async(save_messages, [user_row, assistant_row], st.session_state.user_email)
+
+    update_memory(human_message, ai_response)
+
+def update_memory(human_message, ai_response):
+    memory = st.session_state.memory
+    buffer = list(memory.chat_memory.messages)
+    try:
+        # Pruning may call the summary model
+        memory.save_context({"input": human_message.content}, {"output": ai_response})
+    except LLM_ERRORS as e:
+        # The reply is already shown and saved, so only log. prune() pops the
+        # oldest turns before summarising them; restore the buffer so the next
+        # turn retries the summary instead of losing those turns.
+        print(f"Chat memory summary failed: {e!r}")
+        memory.chat_memory.clear()
+        memory.chat_memory.add_messages([*buffer, human_message, AIMessage(content=ai_response)])
+
 def page_chat():
     st.title("מוקד רפואה מרחוק")
        # Add styled medical record section
-    st.markdown(
-        """
-        <div style="background-color: #f0f8ff; padding: 10px; border-radius: 10px;direction: rtl; text-align: right;">
-            <strong>תיק רפואי של מר. יונתן בניון:</strong> <br>
-            <strong>COPD מתקדם:</strong> Prednisolone 10 mg, Fluticasone inhaler 500 mcg, חמצן <br>
-            <strong>יתר לחץ דם:</strong> Amlodipine 5 mg, Furosemide 40 mg <br>
-            <strong>סוכרת סוג 2:</strong> Novorapid <br>
-            <strong>היסטוריה של עישון כבד:</strong> 40 שנות קופסא, הפסיק לעשן לפני 5 שנים
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
+    st.markdown(MEDICAL_RECORD_HTML, unsafe_allow_html=True)
 
+    rendered_live = 0
     if prompt := st.chat_input("מקום לכתיבה"):
-        with st.spinner("ממתין לתגובה.."):
-            st.session_state.memory.chat_memory.add_message(HumanMessage(content=prompt))
-            full_chat_history = st.session_state.memory.chat_memory
-            query = st.session_state.system_prompt.format_messages(chat_history=full_chat_history)
-            ai_response = st.session_state.llm.invoke(query)
-            st.session_state.memory.chat_memory.add_message(AIMessage(content=ai_response.content))
-
-            # Add user message to chat history
-            current_time = datetime.now()
-            # st.session_state.messages.append({
-            #     "role": "user",
-            #     "content": prompt,
-            #     "from": "assistant",
-            #     "timestamp": current_time.isoformat()
-            # })
-            # st.write("debug:", st.session_state.messages[-1])
-            # st.write(st.session_state)
-            save_message(
-                "user",prompt,st.session_state.user_name,
-                "assistant",current_time,st.session_state.user_email,
-                st.session_state['session_id']
-            )
-            # Display user message in chat message container
-            # with st.chat_message("user"):
-            #     st.markdown(prompt)
-
-            # with st.chat_message("assistant"):
-            #     message_placeholder = st.empty()
-            #     full_response = ""
-            #     full_response = ai_response.content
-            #     # Add a blinking cursor to simulate typing
-            #     message_placeholder.markdown(full_response + "▌")
-            #     message_placeholder.markdown(full_response)
-
-            response_time = datetime.now()
-
-            # Add assistant response to chat history
-            # st.session_state.messages.append({
-            #     "role": "assistant",
-            #     "content": full_response,
-            #     "from": st.session_state.user_name,
-            #     "timestamp": response_time.isoformat()
-            # })
-            save_message(
-                "user",
-                ai_response.content,
-                "assistant",
-                st.session_state.user_name,
-                response_time,
-                st.session_state.user_email,
-                st.session_state['session_id'])
-            # st.write(st.session_state)
-
-    if len(st.session_state.memory.chat_memory.messages) > 10000:
+        human_message = HumanMessage(content=prompt)
+        chat_history = st.session_state.memory.load_memory_variables({})["chat_history"]
+        # The summary of pruned turns, if any, comes first and is always kept
+        summary = chat_history[:1] if st.session_state.memory.moving_summary_buffer else []
+        recent_turns = [*chat_history[len(summary):], human_message]
+        query = [st.session_state.system_message, *summary, *pack_tail(recent_turns)]
+
+        # Newest messages are shown first, so the reply streams in above the prompt
+        assistant_message = st.chat_message("assistant")
+        st.chat_message("user").write(prompt)
+        try:
+            with assistant_message:
+                ai_response = st.write_stream(stream_llm_response(query))
+        except LLM_ERRORS:
+            assistant_message.error(SERVICE_BUSY_MESSAGE)
+        else:
+            rendered_live = 2
+            record_turn(human_message, ai_response)
+
+    if len(st.session_state.transcript) > 10000:
         home_button = st.button("סיום שיחה", icon=":material/send:")
         if home_button:
             st.session_state.page = "Result"
             st.rerun()
 
-    if st.session_state.memory:
-        for msg in st.session_state.memory.chat_memory.messages[st.session_state.starting_index:][::-1]:
+    if st.session_state.transcript:
+        # The turn streamed above is already on screen
+        history_end = len(st.session_state.transcript) - rendered_live
+        for msg in reversed(st.session_state.transcript[st.session_state.starting_index:history_end]):
             role = "user" if isinstance(msg, HumanMessage) else "assistant"
-            st.chat_message(role).write(msg.content.replace("AI:", ""))
+            st.chat_message(role).write(msg.content)
 
 
 def page_home():
@@ -289,10 +383,7 @@ def page_home():
     chat_button = st.button("הקליקו כדי להתחיל בסימולציה")
     if chat_button and user_name:
         user_email = f"{user_name.strip()}@test.cop"
-        new_user = models.user.User(name=user_name, email=user_email)
-        if 'user_added' not in st.session_state:
-            models.user.add_user(new_user, user_email)
-            st.session_state.user_added = True
+        models.user.add_user(user_name, user_email)
         st.session_state.user_name = user_name
         st.session_state.user_email = user_email
 
@@ -311,8 +402,11 @@ def page_result():
 def llm_page_result():
     st.title("Summarize")
     st.write("This is the Result page.")
-    summary = llm_summarize_conversation()
-    st.write(summary)
+    try:
+        summary = st.write_stream(llm_summarize_conversation())
+    except LLM_ERRORS:
+        st.error(SERVICE_BUSY_MESSAGE)
+        return
     result_time = datetime.now()
     save_result(summary, result_time, st.session_state.user_email, st.session_state['session_id'])
 
@@ -351,10 +445,23 @@ def llm_summarize_conversation():
         {full_conversation}
         """
 
-    docs = [Document(page_content=f"{full_conversation}\n\n{summarize_prompt}")]
-
-    summarize_chain = load_summarize_chain(llm=st.session_state.llm, chain_type="stuff")
-    return summarize_chain.run(docs)
+    eval_llm = st.session_state.eval_llm
+    # .stream() never consults the global LLM cache, so look the feedback up directly
+    llm_cache = get_global_llm_cache()
+    llm_string = f"{eval_llm.model_name}:{eval_llm.temperature}:{eval_llm.max_tokens}"
+    if llm_cache is not None:
+        cached = llm_cache.lookup(summarize_prompt, llm_string)
+        if cached:
+            yield cached[0].text
+            return
+
+    feedback = []
+    for chunk in eval_llm.stream([HumanMessage(content=summarize_prompt)]):
+        feedback.append(chunk.content)
+        yield chunk.content
+    # Only a fully streamed reply is cached
+    if llm_cache is not None:
+        llm_cache.update(summarize_prompt, llm_string, [Generation(text="".join(feedback))])
 
 def summarize_chat():
     if len(st.session_state.messages) == 0:
@@ -387,9 +494,13 @@ def summarize_chat():
 
 # page = st.radio("Choose a page", ("home", "Chat", "Result"))
 # Display the corresponding page
-if st.session_state.page == "Home":
-    page_home()
-elif st.session_state.page == "Chat":
-    page_chat()
-elif st.session_state.page == "Result":
-    llm_page_result()
+try:
+    if st.session_state.page == "Home":
+        page_home()
+    elif st.session_state.page == "Chat":
+        page_chat()
+    elif st.session_state.page == "Result":
+        llm_page_result()
+finally:
+    # Hand this run's DB connection back to the pool
+    database.ScopedSession.remove()